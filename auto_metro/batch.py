@@ -1,73 +1,1001 @@
 import string
 import logging
 import os
+import time
+import heapq
+import json
+import socket
+import sqlite3
+import threading
+import uuid
 from datetime import date
+from pathlib import Path
 
 from itertools import product
 import numpy as np
 import pandas as pd
 
+from . import metrics
+from .metrics import METRICS
+
 log = logging.getLogger(__file__)
 log.setLevel(logging.DEBUG)
 
-logdir = os.environ.get("MEASURE_LOG_DIRECTORY", ".")
-logfile = f"measures_{date.today().isoformat()}.log"
-hand = logging.FileHandler(logfile)
-hand.setLevel(logging.DEBUG)
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-hand.setFormatter(formatter)
 
+def setup_logging(logdir=None):
+    """Attaches a file handler to the batch logger, writing to
+    "measures_<date>.log" in `logdir`, or in the directory given by the
+    `MEASURE_LOG_DIRECTORY` environment variable (defaults to the working directory)
 
-def measure_single(image_reader, measure, columns, progress_bar=None, **kwargs):
+    Successive calls keep a single handler: the one already attached is
+    returned if it writes to the same file, else it is closed and replaced.
+
+    Returns
+    -------
+    handler : the logging.FileHandler
+    """
+    if logdir is None:
+        logdir = os.environ.get("MEASURE_LOG_DIRECTORY", ".")
+    logfile = os.path.join(logdir, f"measures_{date.today().isoformat()}.log")
+    for hand in log.handlers[:]:
+        if not isinstance(hand, logging.FileHandler):
+            continue
+        if hand.baseFilename == os.path.abspath(logfile):
+            return hand
+        log.removeHandler(hand)
+        hand.close()
+    hand = logging.FileHandler(logfile)
+    hand.setLevel(logging.DEBUG)
+    formatter = logging.Formatter(
+        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    hand.setFormatter(formatter)
+    log.addHandler(hand)
+    return hand
+
+
+# Number of planes written to disk at once by `measure_process`
+CHUNKSIZE = 64
+# Minimum size of the string columns in the HDF5 tables
+MIN_ITEMSIZE = {
+    "ChannelLabel": 32,
+    "resolution_unit": 8,
+    "Path": 256,
+    "worker": 64,
+    "kind": 8,
+}
+# Arrow types of the known columns of the Parquet files, so that all the files
+# of a table share one schema whatever the values of each chunk
+PARQUET_TYPES = {
+    "Id": "int64",
+    "AquisitionDate": "timestamp[ns]",
+    "LensNA": "float64",
+    "ChannelLabel": "string",
+    "PhysicalSizeX": "float64",
+    "C": "int64",
+    "Z": "int64",
+    "T": "int64",
+    "SNR": "float64",
+    "resolution": "float64",
+    "resolution_unit": "string",
+    "Path": "string",
+    "worker": "string",
+    "kind": "string",
+}
+# Indexed columns of the results tables
+INDEX_COLUMNS = ["AquisitionDate", "Id", "ChannelLabel", "LensNA", "PhysicalSizeX"]
+# Columns grouping the daily rollups, on top of the date
+ROLLUP_BY = ["LensNA", "ChannelLabel", "resolution_unit"]
+# Columns summarized in the daily rollups, with their percentiles
+ROLLUP_VALUES = ["SNR", "resolution"]
+ROLLUP_PERCENTILES = [10, 50, 90]
 
+
+def measure_iter(
+    image_reader,
+    measure,
+    columns,
+    chunksize=1,
+    progress_bar=None,
+    **kwargs,
+):
+    """Measures each plane of an image and yields the results as they
+    are computed.
+
+    Parameters
+    ----------
+    image_reader : an ImageReader instance
+    measure : function
+        the measure function, called as `measure(plane, metadata, **kwargs)`
+        and returning a dictionnary
+    columns : list of str
+        the columns of the output DataFrames
+    chunksize : int
+        the number of planes per yielded DataFrame
+    progress_bar : an optional ipywidgets progress bar
+
+    Yields
+    ------
+    data : pd.DataFrame
+        the measures for at most `chunksize` planes, indexed by
+        the plane index in the image
+
+    """
     metadata = image_reader.get_metadata()
     size_z = metadata["SizeZ"]
     size_c = metadata["SizeC"]
     size_t = metadata["SizeT"]
-    data = pd.DataFrame(
-        np.empty((size_z * size_c * size_t, len(columns))), columns=columns
-    )
+    num_planes = size_z * size_c * size_t
     labels = metadata.get("ChannelLabels", string.ascii_uppercase[:size_c])
-    for col in columns:
-        if col in metadata:
-            data[col] = metadata[col]
 
     if progress_bar is not None:
-        progress_bar.max = size_z * size_c * size_t
+        progress_bar.max = num_planes
         progress_bar.value = 0
 
+    index, czts, measured = [], [], []
     for i, ((c, z, t), plane) in enumerate(image_reader):
         if progress_bar is not None:
-            progress_bar.description = f"Frame {i}/{size_z * size_c * size_t}"
+            progress_bar.description = f"Frame {i}/{num_planes}"
             progress_bar.value = i + 1
 
-        data.loc[i, ["C", "Z", "T"]] = c, z, t
-        data.loc[i, "ChannelLabel"] = labels[c]
-        m = measure(plane, metadata, **kwargs)
-        for key in m:
-            data.loc[i, key] = m[key]
-    data["AquisitionDate"] = pd.to_datetime(data["AquisitionDate"])
+        index.append(i)
+        czts.append((c, z, t))
+        with METRICS.timer("measure"):
+            measured.append(measure(plane, metadata, **kwargs))
+        METRICS.record(Id=image_reader.id, C=c, Z=z, T=t, planes=1)
+        if len(index) == chunksize:
+            yield _planes_frame(index, czts, measured, metadata, labels, columns)
+            index, czts, measured = [], [], []
+
+    if index:
+        yield _planes_frame(index, czts, measured, metadata, labels, columns)
+
 
+def _planes_frame(index, czts, measured, metadata, labels, columns):
+    """Gathers the measures of a batch of planes in a DataFrame
+    """
+    data = pd.DataFrame(np.nan, index=index, columns=columns)
+    for col in columns:
+        if col in metadata:
+            data[col] = metadata[col]
+
+    czts = np.asarray(czts, dtype=float)
+    data["C"], data["Z"], data["T"] = czts.T
+    data["ChannelLabel"] = [labels[int(c)] for c in czts[:, 0]]
+    measured = pd.DataFrame.from_records(measured, index=index)
+    for key in measured:
+        data[key] = measured[key]
+    if "AquisitionDate" in data:
+        data["AquisitionDate"] = pd.to_datetime(data["AquisitionDate"])
     return data
 
 
-def measure_process(lock, hf5_record, image_reader, measure, columns, **kwargs):
+def measure_single(image_reader, measure, columns, progress_bar=None, **kwargs):
+    """Measures all the planes of an image and returns the results
+    as a single DataFrame.
+
+    See Also
+    --------
+    measure_iter : the streaming version of this function
+    """
+    return pd.concat(
+        measure_iter(
+            image_reader,
+            measure,
+            columns,
+            chunksize=CHUNKSIZE,
+            progress_bar=progress_bar,
+            **kwargs,
+        )
+    )
+
+
+def measure_process(
+    lock, hf5_record, image_reader, measure, columns, chunksize=None, **kwargs
+):
+    """Measures an image and appends the results to the `hf5_record` file,
+    one chunk of `chunksize` planes at a time, so that memory use does not
+    grow with the image size and partial results are stored on disk.
+
+    If instrumentation is enabled (see `auto_metro.metrics`), the stage timings
+    are appended to the "<module>_metrics" table of the same file.
+
+    The daily rollups are only marked as stale, call
+    `ResultsStore(hf5_record).refresh_rollups()` at the end of the run.
+
+    Returns
+    -------
+    num_records : int
+        the number of records written
+
+    See Also
+    --------
+    measure_to_sink : the same function for any ResultSink
+    """
+    sink = HDFSink(hf5_record, lock)
+    return measure_to_sink(
+        sink, image_reader, measure, columns, chunksize=chunksize, **kwargs
+    )
+
+
+def measure_to_sink(sink, image_reader, measure, columns, chunksize=None, **kwargs):
+    """Measures an image and writes the results to `sink`, one chunk
+    of `chunksize` planes at a time.
+
+    The results are written under the name of the measure module,
+    e.g. "image_decorr", and the metrics, if enabled, under "<module>_metrics".
+
+    Parameters
+    ----------
+    sink : a ResultSink instance, closed at the end of the measure
+    image_reader : an ImageReader instance
+    measure : function, see `measure_iter`
+    columns : list of str
+
+    Returns
+    -------
+    num_records : int
+        the number of records written
+    """
     module = measure.__module__.split(".")[-1]
+    chunksize = chunksize or CHUNKSIZE
+    log.info(f"treating image  #{image_reader.id}")
+    num_records = 0
     try:
-        log.info(f"treating image  #{image_reader.id}")
-        data = measure_single(
-            image_reader, measure, columns, progress_bar=None, **kwargs
-        )
+        for data in measure_iter(
+            image_reader, measure, columns, chunksize=chunksize, **kwargs
+        ):
+            sink.write(module, data)
+            METRICS.record(kind="write", Id=image_reader.id, planes=data.shape[0])
+            num_records += data.shape[0]
     except Exception as e:
         log.info(
             f"Error {type(e)}: {e} in measuring image {image_reader.id}"
             f" with {measure.__name__} from {module}"
+            f" after {num_records} records"
         )
         raise e
-    try:
-        lock.acquire()
-        with pd.HDFStore(hf5_record, "a") as file:
-            file.append(key=module, value=data, data_columns=["AquisitionDate"])
     finally:
-        lock.release()
+        if METRICS.enabled:
+            data = METRICS.to_frame()[metrics.COLUMNS]
+            if not data.empty:
+                sink.write(f"{module}_metrics", data)
+            # the metrics write must not be counted in the next image records
+            METRICS.discard()
+        sink.close()
+    return num_records
+
+
+class ResultSink:
+    """Abstract destination of the measure results
+
+    `write` is called with chunks of the results, and `close` once
+    all the chunks of an image have been written.
+    """
+
+    def write(self, key, data):
+        """Writes the DataFrame `data` to the `key` table
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class HDFSink(ResultSink):
+    """Writes the results to a ResultsStore HDF5 file
+
+    The writes are serialized by `lock`, which must be shared by
+    all the processes writing to the same file. The writes only mark
+    the daily rollups of the new data as stale, call `refresh_rollups`
+    once the run is over to recompute them.
+    """
+
+    def __init__(self, path, lock):
+        self.store = ResultsStore(path)
+        self.lock = lock
+
+    def write(self, key, data):
+        try:
+            with METRICS.timer("lock"):
+                self.lock.acquire()
+            with METRICS.timer("write"):
+                self.store.append(key, data, update_rollup=False)
+        finally:
+            self.lock.release()
+
+    def refresh_rollups(self):
+        """Recomputes the stale rollups of the store, see `ResultsStore.refresh_rollups`
+        """
+        try:
+            self.lock.acquire()
+            self.store.refresh_rollups()
+        finally:
+            self.lock.release()
+
+
+class ParquetSink(ResultSink):
+    """Writes the results as Parquet files, requires `pyarrow`
+
+    Each call to `write` creates new files, so several workers can
+    write to the same directory without any lock. The files are
+    partitioned by measure module and acquisition day::
+
+        root/module=image_decorr/date=2020-03-01/part-<uuid>.parquet
+
+    The known columns are written with the Arrow types of `PARQUET_TYPES`,
+    so that a chunk where a column is empty (e.g. no LensNA) can be read
+    back together with the others.
+
+    See Also
+    --------
+    read_parquet : reads the results back
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def write(self, key, data):
+        import pyarrow.parquet as pq
+
+        with METRICS.timer("write"):
+            if "AquisitionDate" in data:
+                dates = pd.to_datetime(data["AquisitionDate"])
+                days = dates.dt.strftime("%Y-%m-%d").fillna("unknown")
+            else:
+                days = pd.Series("unknown", index=data.index)
+            for day, chunk in data.groupby(days):
+                directory = self.root / f"module={key}" / f"date={day}"
+                directory.mkdir(parents=True, exist_ok=True)
+                pq.write_table(
+                    _arrow_table(chunk),
+                    directory / f"part-{uuid.uuid4().hex}.parquet",
+                )
+
+
+def _arrow_table(data):
+    """Converts data to an Arrow table, with the types in `PARQUET_TYPES`
+    for the known columns
+    """
+    import pyarrow as pa
+
+    schema = pa.Schema.from_pandas(data)
+    for col, dtype in PARQUET_TYPES.items():
+        if col in data:
+            field = pa.field(col, pa.type_for_alias(dtype))
+            schema = schema.set(schema.get_field_index(col), field)
+    return pa.Table.from_pandas(data, schema=schema)
+
+
+def read_parquet(root, key, columns=None, start=None, stop=None, filters=None):
+    """Reads the results written by ParquetSink
+
+    Parameters
+    ----------
+    root : str, the ParquetSink root directory
+    key : str, the measure module
+    columns : list of str, optional, only those columns are read
+    start, stop : optional dates bounding the acquisition day (stop excluded),
+        only the matching partitions are read
+    filters : list of (column, op, value) tuples, optional
+        additional row filters, see `pyarrow.parquet.read_table`
+
+    Returns
+    -------
+    data : pd.DataFrame
+    """
+    filters = list(filters or [])
+    if start is not None:
+        filters.append(("date", ">=", pd.Timestamp(start).strftime("%Y-%m-%d")))
+    if stop is not None:
+        filters.append(("date", "<", pd.Timestamp(stop).strftime("%Y-%m-%d")))
+    data = pd.read_parquet(
+        Path(root) / f"module={key}", columns=columns, filters=filters or None
+    )
+    if "date" in data and (columns is None or "date" not in columns):
+        data = data.drop(columns="date")
     return data
+
+
+class ResultsStore:
+    """HDF5 results file with indexed columns and daily rollups
+
+    The columns in `INDEX_COLUMNS` are stored as indexed data columns,
+    so that `query` only reads the matching rows. For each results table
+    `key`, the "<key>_daily" table holds, per day and per `ROLLUP_BY`
+    group, the number of planes and the percentiles of the `ROLLUP_VALUES`.
+    The rollups are recomputed only for the days touched by new data,
+    either on `append`, or later with `refresh_rollups`, so that a single
+    long-lived store holds the whole history (one file per run would split
+    the days spanning several runs in as many partial rollups).
+
+    Note
+    ----
+
+    The store does not lock the file, concurrent writers must share a lock
+    as in `measure_process`.
+
+    Usage
+    -----
+
+    .. code-block:: python
+
+        store = ResultsStore("measures.hf5")
+        gfp = store.query("image_decorr", ChannelLabel="GFP", start="2020-03-01")
+        trend = store.rollup("image_decorr", LensNA=[1.2, 1.4])
+
+    """
+
+    def __init__(self, path, rollup_by=None):
+        self.path = path
+        self.rollup_by = rollup_by if rollup_by is not None else ROLLUP_BY
+
+    def append(self, key, data, update_rollup=True):
+        """Appends data to the `key` table
+
+        If update_rollup is True, the rollups of the days present in data
+        are updated, otherwise they are marked as stale, to be recomputed
+        by `refresh_rollups` once all the data is written.
+        """
+        data_columns = [col for col in INDEX_COLUMNS if col in data]
+        days = pd.Series([], dtype="datetime64[ns]")
+        if "AquisitionDate" in data:
+            days = data["AquisitionDate"].dt.normalize().dropna().drop_duplicates()
+        with pd.HDFStore(self.path, "a") as file:
+            file.append(
+                key=key,
+                value=data,
+                data_columns=data_columns,
+                min_itemsize={k: v for k, v in MIN_ITEMSIZE.items() if k in data},
+            )
+            if not update_rollup and not days.empty:
+                file.append(
+                    key=f"{key}_stale",
+                    value=pd.DataFrame({"date": days.to_numpy()}),
+                    data_columns=["date"],
+                )
+        if update_rollup:
+            self.update_rollup(key, days)
+
+    def refresh_rollups(self, key=None):
+        """Recomputes the rollups of the days marked as stale by `append`
+
+        Parameters
+        ----------
+        key : str, optional
+            the results table, by default all the tables with stale rollups
+
+        Returns
+        -------
+        num_days : int, the number of recomputed days
+        """
+        with pd.HDFStore(self.path, "a") as file:
+            stale = {k[1:] for k in file.keys() if k.endswith("_stale")}
+            if key is not None:
+                stale &= {f"{key}_stale"}
+            days = {
+                stale_key[: -len("_stale")]: file.select(stale_key)["date"].unique()
+                for stale_key in stale
+            }
+        num_days = 0
+        for table, table_days in days.items():
+            self.update_rollup(table, table_days)
+            with pd.HDFStore(self.path, "a") as file:
+                file.remove(f"{table}_stale")
+            num_days += len(table_days)
+        return num_days
+
+    def query(self, key, columns=None, start=None, stop=None, **filters):
+        """Selects the rows of the `key` table
+
+        Parameters
+        ----------
+        key : str, the table name (i.e. the measure module)
+        columns : list of str, optional, the columns to return
+        start, stop : optional dates bounding the acquisition date (stop excluded)
+        **filters : conditions on the indexed columns, as scalar values
+            or lists of accepted values, e.g. `ChannelLabel=["GFP", "RFP"]`
+
+        Returns
+        -------
+        data : pd.DataFrame
+        """
+        where = _where(start, stop, "AquisitionDate", filters)
+        with pd.HDFStore(self.path, "r") as file:
+            return file.select(key, where=where or None, columns=columns)
+
+    def rollup(self, key, start=None, stop=None, **filters):
+        """Selects the daily rollups of the `key` table, with the same
+        arguments as `query`, filters apply to the `ROLLUP_BY` columns
+
+        The days written with `update_rollup=False` are only included
+        after a call to `refresh_rollups`.
+        """
+        where = _where(start, stop, "date", filters)
+        with pd.HDFStore(self.path, "r") as file:
+            if f"/{key}_daily" not in file.keys():
+                return pd.DataFrame()
+            return file.select(f"{key}_daily", where=where or None)
+
+    def update_rollup(self, key, days):
+        """Recomputes the rollups of the `key` table for the given days
+        """
+        days = sorted(set(pd.to_datetime(list(days))))
+        if not days:
+            return
+        rollup_key = f"{key}_daily"
+        with pd.HDFStore(self.path, "a") as file:
+            rollups = []
+            for day in days:
+                where = [
+                    f"AquisitionDate >= {day!r}",
+                    f"AquisitionDate < {day + pd.Timedelta(days=1)!r}",
+                ]
+                data = file.select(key, where=where)
+                if f"/{rollup_key}" in file.keys():
+                    file.remove(rollup_key, where=[f"date == {day!r}"])
+                rollups.append(self._rollup(data, day))
+            rollup = pd.concat(rollups, ignore_index=True)
+            if not rollup.empty:
+                file.append(
+                    key=rollup_key,
+                    value=rollup,
+                    data_columns=["date"] + self.rollup_by,
+                    min_itemsize={
+                        k: v for k, v in MIN_ITEMSIZE.items() if k in rollup
+                    },
+                )
+
+    def _rollup(self, data, day):
+        by = [col for col in self.rollup_by if col in data]
+        values = [col for col in ROLLUP_VALUES if col in data]
+        if by:
+            groups = data.groupby(by, dropna=False)
+        else:
+            groups = data.groupby(np.zeros(data.shape[0]))
+        rollup = groups.size().rename("count").to_frame()
+        for col in values:
+            for q in ROLLUP_PERCENTILES:
+                rollup[f"{col}_p{q}"] = groups[col].quantile(q / 100)
+        rollup = rollup.reset_index() if by else rollup.reset_index(drop=True)
+        rollup.insert(0, "date", day)
+        return rollup
+
+
+def _where(start, stop, date_column, filters):
+    where = []
+    if start is not None:
+        where.append(f"{date_column} >= {pd.Timestamp(start)!r}")
+    if stop is not None:
+        where.append(f"{date_column} < {pd.Timestamp(stop)!r}")
+    for col, value in filters.items():
+        if np.ndim(value):
+            values = [np.asarray(v).item() for v in value]
+            where.append(f"{col} in {values!r}")
+        else:
+            where.append(f"{col} == {np.asarray(value).item()!r}")
+    return where
+
+
+def image_work(metadata):
+    """Returns the amount of work needed to measure an image, in arbitrary units.
+
+    The measures are dominated by 2D FFTs, so the work per plane
+    scales as N log N, with N = SizeX * SizeY.
+    """
+    num_pixels = metadata.get("SizeX", 1) * metadata.get("SizeY", 1)
+    num_planes = metadata["SizeZ"] * metadata["SizeC"] * metadata["SizeT"]
+    return num_planes * num_pixels * np.log2(max(num_pixels, 2))
+
+
+class CostModel:
+    """Linear model of the time needed to measure an image,
+    `overhead + rate * image_work(metadata)`, in seconds
+
+    Attributes
+    ----------
+    rate : float, the time per unit of work
+    overhead : float, the fixed time per image (connection, metadata...)
+    """
+
+    def __init__(self, rate=1e-7, overhead=1.0):
+        self.rate = rate
+        self.overhead = overhead
+
+    def predict(self, metadata):
+        """Returns the predicted time to measure the image with this metadata
+        """
+        return self.overhead + self.rate * image_work(metadata)
+
+    def fit(self, works, timings):
+        """Calibrates the model from past timings
+
+        Parameters
+        ----------
+        works : sequence of floats, the `image_work` of each past image
+        timings : sequence of floats, the measured time for each of those images
+
+        Returns
+        -------
+        self
+        """
+        works = np.asarray(works, dtype=float)
+        timings = np.asarray(timings, dtype=float)
+        if np.unique(works).size < 2:
+            # not enough data to fit the overhead, only adjust the rate
+            if works.sum() > 0:
+                self.rate = max((timings - self.overhead).sum(), 0) / works.sum()
+            return self
+
+        A = np.vstack([works, np.ones_like(works)]).T
+        (rate, overhead), *_ = np.linalg.lstsq(A, timings, rcond=None)
+        self.rate = max(rate, 0.0)
+        self.overhead = max(overhead, 0.0)
+        return self
+
+
+def expected_makespan(costs, num_workers):
+    """Returns the time to run all the tasks with the given costs
+    on `num_workers` workers, if each idle worker takes the next
+    task in the order of `costs`
+    """
+    workers = [0.0] * min(num_workers, max(len(costs), 1))
+    for cost in costs:
+        heapq.heappush(workers, heapq.heappop(workers) + cost)
+    return max(workers)
+
+
+class CostScheduler:
+    """Dispatches images to a process pool, largest predicted cost first.
+
+    The tasks are sent one at a time to the workers (`chunksize=1`),
+    so an idle worker always picks the largest remaining image, and the
+    long ones don't end up last on a single worker.
+
+    Usage
+    -----
+
+    .. code-block:: python
+
+        scheduler = CostScheduler(num_workers=6)
+        with Pool(6) as pool:
+            for result in scheduler.run(pool, target, args, metadatas):
+                pass
+        scheduler.cost_model.fit(scheduler.timings["work"], scheduler.timings["time"])
+
+    Attributes
+    ----------
+    num_workers : int
+    cost_model : a CostModel instance
+    timings : pd.DataFrame
+        the measured time for each finished task, with the
+        columns "work", "predicted" and "time"
+    """
+
+    def __init__(self, num_workers, cost_model=None):
+        self.num_workers = num_workers
+        self.cost_model = cost_model if cost_model is not None else CostModel()
+        self._timings = []
+
+    @property
+    def timings(self):
+        return pd.DataFrame(self._timings, columns=["work", "predicted", "time"])
+
+    def plan(self, metadatas):
+        """Orders the tasks by decreasing predicted cost
+
+        Returns
+        -------
+        order : np.ndarray, the indices of the tasks in dispatch order
+        makespan : float, the expected total time in seconds
+        """
+        costs = np.array([self.cost_model.predict(m) for m in metadatas])
+        order = np.argsort(-costs, kind="stable")
+        makespan = expected_makespan(costs[order], self.num_workers)
+        return order, makespan
+
+    def run(self, pool, func, args, metadatas):
+        """Runs `func(*arg)` for each arg in `args` on the pool,
+        and yields the results as they are completed
+
+        Parameters
+        ----------
+        pool : a multiprocessing Pool
+        func : the function to run, must be picklable
+        args : list of argument tuples
+        metadatas : list of image metadata dictionnaries, one per tuple in args
+        """
+        order, makespan = self.plan(metadatas)
+        log.info(
+            f"Dispatching {len(order)} images on {self.num_workers} workers,"
+            f" expected makespan {makespan:.1f}s"
+        )
+        tasks = [(i, func, args[i]) for i in order]
+        for i, duration, result in pool.imap_unordered(
+            _timed_call, tasks, chunksize=1
+        ):
+            self._timings.append(
+                (
+                    image_work(metadatas[i]),
+                    self.cost_model.predict(metadatas[i]),
+                    duration,
+                )
+            )
+            yield result
+
+
+def _timed_call(task):
+    i, func, args = task
+    start = time.perf_counter()
+    result = func(*args)
+    return i, time.perf_counter() - start, result
+
+
+class WorkQueue:
+    """Abstract job queue shared by several worker processes, possibly
+    on different hosts.
+
+    Items are enqueued once, then leased by the workers for a limited time.
+    A worker must renew its lease with `heartbeat` while it processes the item,
+    and report the outcome with `complete` or `fail`. Items whose lease expired
+    (e.g. because the worker crashed) are leased again to another worker,
+    up to `max_attempts` times.
+    """
+
+    def enqueue(self, items):
+        """Adds the items to the queue, items already in the queue are ignored
+        """
+        raise NotImplementedError
+
+    def lease(self, worker):
+        """Leases the next available item to `worker`, returns None
+        if there is no item left to process
+        """
+        raise NotImplementedError
+
+    def heartbeat(self, item, worker):
+        """Renews the lease on `item`, returns False if the lease was lost
+        """
+        raise NotImplementedError
+
+    def complete(self, item, worker, result=None):
+        """Marks the item as done, with an optional json serializable result
+        """
+        raise NotImplementedError
+
+    def fail(self, item, worker, error=""):
+        """Reports an error while processing the item, which will be leased
+        again if it has attempts left
+        """
+        raise NotImplementedError
+
+    def counts(self):
+        """Returns a dictionnary with the number of items in each status
+        """
+        raise NotImplementedError
+
+    def next_expiry(self):
+        """Returns the time (as given by `time.time`) at which the first
+        current lease expires, or None if no item is leased
+        """
+        raise NotImplementedError
+
+
+class SQLiteWorkQueue(WorkQueue):
+    """WorkQueue backed by a SQLite file, which can be put on shared storage.
+
+    Each operation opens its own connection, so an instance can be
+    used from several threads and sent to forked processes.
+
+    Note
+    ----
+    SQLite locking relies on the file system, which must support
+    POSIX locks for several hosts to share the same file.
+
+    Parameters
+    ----------
+    path : str, the database file, created if needed
+    lease_timeout : float, the lease duration in seconds
+    max_attempts : int, the number of leases before an item is marked as failed
+    """
+
+    statuses = ("pending", "leased", "done", "failed")
+
+    def __init__(self, path, lease_timeout=600.0, max_attempts=3):
+        self.path = str(path)
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        with self._connect() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    item INTEGER PRIMARY KEY,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    error TEXT
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=60.0, isolation_level=None)
+        return _Transaction(conn)
+
+    def enqueue(self, items):
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO jobs (item) VALUES (?)",
+                [(int(item),) for item in items],
+            )
+
+    def lease(self, worker):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = 'lease expired'"
+                " WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, self.max_attempts),
+            )
+            row = conn.execute(
+                "SELECT item FROM jobs WHERE status = 'pending'"
+                " OR (status = 'leased' AND lease_expires < ?)"
+                " ORDER BY item LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'leased', worker = ?, lease_expires = ?,"
+                " attempts = attempts + 1 WHERE item = ?",
+                (worker, now + self.lease_timeout, row[0]),
+            )
+        return row[0]
+
+    def heartbeat(self, item, worker):
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires = ?"
+                " WHERE item = ? AND worker = ? AND status = 'leased'",
+                (time.time() + self.lease_timeout, item, worker),
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, item, worker, result=None):
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'done', result = ?"
+                " WHERE item = ? AND worker = ? AND status = 'leased'",
+                (json.dumps(result), item, worker),
+            )
+        return cursor.rowcount == 1
+
+    def fail(self, item, worker, error=""):
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET error = ?, status = CASE WHEN attempts < ?"
+                " THEN 'pending' ELSE 'failed' END"
+                " WHERE item = ? AND worker = ? AND status = 'leased'",
+                (error, self.max_attempts, item, worker),
+            )
+        return cursor.rowcount == 1
+
+    def counts(self):
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+            ).fetchall()
+        counts = dict.fromkeys(self.statuses, 0)
+        counts.update(rows)
+        return counts
+
+    def next_expiry(self):
+        with self._connect() as conn:
+            (expires,) = conn.execute(
+                "SELECT MIN(lease_expires) FROM jobs WHERE status = 'leased'"
+            ).fetchone()
+        return expires
+
+    def results(self):
+        """Returns a DataFrame with the status, worker, attempts,
+        result and error of each item
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT item, status, worker, attempts, result, error FROM jobs"
+            ).fetchall()
+        data = pd.DataFrame(
+            rows, columns=["item", "status", "worker", "attempts", "result", "error"]
+        ).set_index("item")
+        data["result"] = [
+            json.loads(result) if result is not None else None
+            for result in data["result"]
+        ]
+        return data
+
+
+class _Transaction:
+    """Context manager running a sqlite connection in a single
+    write transaction, closing it on exit
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.conn.close()
+
+
+def run_worker(queue, func, worker=None, heartbeat_interval=None, poll_interval=1.0):
+    """Processes items from `queue` until all of them are done or failed
+
+    When no item is available but some are leased by other workers,
+    the worker waits for them to be completed, or for their lease to
+    expire (e.g. if the other worker crashed) to process them itself.
+
+    Parameters
+    ----------
+    queue : a WorkQueue instance
+    func : function
+        called as `func(item)` for each leased item, its
+        return value is passed to `queue.complete`
+    worker : str, the worker name, defaults to "hostname:pid"
+    heartbeat_interval : float
+        time between lease renewals, defaults to a third of
+        the queue lease timeout
+    poll_interval : float
+        maximum time between two checks of the queue while
+        waiting for the items leased by other workers
+
+    Returns
+    -------
+    num_items : int, the number of items processed by this worker
+    """
+    if worker is None:
+        worker = f"{socket.gethostname()}:{os.getpid()}"
+    if heartbeat_interval is None:
+        heartbeat_interval = queue.lease_timeout / 3
+
+    num_items = 0
+    while True:
+        item = queue.lease(worker)
+        if item is None:
+            expires = queue.next_expiry()
+            if expires is None:
+                return num_items
+            time.sleep(min(max(expires - time.time(), 0.0), poll_interval))
+            continue
+
+        stop = threading.Event()
+        beat = threading.Thread(
+            target=_heartbeat,
+            args=(queue, item, worker, heartbeat_interval, stop),
+            daemon=True,
+        )
+        beat.start()
+        try:
+            result = func(item)
+        except Exception as e:
+            log.info(f"Error {type(e)}: {e} in processing item {item} on {worker}")
+            queue.fail(item, worker, f"{type(e).__name__}: {e}")
+        else:
+            queue.complete(item, worker, result)
+        finally:
+            stop.set()
+            beat.join()
+        num_items += 1
+
+
+def _heartbeat(queue, item, worker, interval, stop):
+    while not stop.wait(interval):
+        if not queue.heartbeat(item, worker):
+            log.info(f"Lost lease on item {item} for {worker}")
+            return
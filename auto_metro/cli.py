@@ -0,0 +1,448 @@
+"""Command line interface to run the measures in batch
+
+Usage
+-----
+
+.. code-block:: sh
+
+    # local image files, results in a HDF5 file
+    auto-metro local samples/*.tif --output measures.hf5
+    # images from an OMERO server, results as Parquet files
+    auto-metro omero --host omero.example.org --user me --output measures_parquet/
+    # the same, distributed over several hosts through a queue on shared storage
+    auto-metro enqueue /shared/queue.db --host omero.example.org --user me
+    auto-metro --workers 4 --output /shared/measures/ worker /shared/queue.db \\
+        --host omero.example.org --user me   # on each host
+
+Unless `--workers` and `--threads` are given, the split between worker
+processes and FFT / BLAS threads per process is chosen from a short
+calibration run on the center of the first plane of the first image.
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import time
+from contextlib import contextmanager, ExitStack
+from functools import partial
+from getpass import getpass
+from multiprocessing import Manager, Pool
+
+from . import batch, image_decorr, imageio
+
+COLUMNS = [
+    "Id",
+    "AquisitionDate",
+    "LensNA",
+    "ChannelLabel",
+    "PhysicalSizeX",
+    "C",
+    "Z",
+    "T",
+    "SNR",
+    "resolution",
+    "resolution_unit",
+]
+# Local files are also identified by their path
+LOCAL_COLUMNS = COLUMNS + ["Path"]
+
+THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+]
+
+# Size of the central crop of the plane timed by `tune`
+CALIBRATION_SIZE = 512
+
+# Thread limits of a pool worker, kept open for the life of the process
+_worker_limits = ExitStack()
+
+
+@contextmanager
+def thread_limits(threads):
+    """Limits the number of threads used by scipy.fft and,
+    if `threadpoolctl` is installed, by the BLAS and OpenMP libraries
+    """
+    from scipy.fft import set_workers
+
+    with ExitStack() as stack:
+        stack.enter_context(set_workers(threads))
+        try:
+            from threadpoolctl import threadpool_limits
+        except ImportError:
+            pass
+        else:
+            stack.enter_context(threadpool_limits(threads))
+        yield
+
+
+def tune(plane, metadata, num_cpus=None, repeat=2):
+    """Chooses the number of worker processes and of threads per process
+
+    The measure of the central `CALIBRATION_SIZE` square of `plane` is timed
+    with 1, 2, 4... threads, and the split of the CPUs maximizing the expected throughput,
+    `workers / time(threads)` with `workers * threads <= num_cpus`, is chosen.
+
+    Returns
+    -------
+    workers : int
+    threads : int
+    plane_time : float, the time to measure the cropped plane
+    """
+    num_cpus = num_cpus or os.cpu_count() or 1
+    best = None
+    threads = 1
+    while threads <= num_cpus:
+        plane_time = time_plane(plane, metadata, threads, repeat)
+        workers = num_cpus // threads
+        if best is None or workers / plane_time > best[0] / best[2]:
+            best = (workers, threads, plane_time)
+        threads *= 2
+    return best
+
+
+def time_plane(plane, metadata, threads, repeat=2):
+    """Returns the best time to measure the center of `plane`
+    with `threads` threads
+    """
+    plane = calibration_plane(plane)
+    with thread_limits(threads):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            image_decorr.measure(plane, metadata)
+            timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def calibration_plane(plane):
+    """Returns the central `CALIBRATION_SIZE` square of plane
+    """
+    size_y, size_x = plane.shape
+    y0 = max((size_y - CALIBRATION_SIZE) // 2, 0)
+    x0 = max((size_x - CALIBRATION_SIZE) // 2, 0)
+    return plane[y0 : y0 + CALIBRATION_SIZE, x0 : x0 + CALIBRATION_SIZE]
+
+
+def cost_model(plane, plane_time):
+    """Returns a `batch.CostModel` whose rate is calibrated from
+    `plane_time`, the time to measure the center of `plane`
+    """
+    size_y, size_x = calibration_plane(plane).shape
+    work = batch.image_work(
+        {"SizeX": size_x, "SizeY": size_y, "SizeZ": 1, "SizeC": 1, "SizeT": 1}
+    )
+    return batch.CostModel(rate=plane_time / work)
+
+
+def _init_worker(threads):
+    _worker_limits.enter_context(thread_limits(threads))
+
+
+def _measure_file(path, metadata, sink):
+    try:
+        with imageio.FileImageReader(path, metadata) as image_reader:
+            return batch.measure_to_sink(
+                sink, image_reader, image_decorr.measure, LOCAL_COLUMNS
+            )
+    except Exception as e:
+        print(f"Error {e} for {path}", file=sys.stderr)
+        return 0
+
+
+def _omero_connection(credentials):
+    from omero.gateway import BlitzGateway
+
+    return BlitzGateway(
+        credentials["user"],
+        credentials["password"],
+        host=credentials["host"],
+        port=credentials["port"],
+    )
+
+
+def _measure_omero(im_id, credentials, sink):
+    try:
+        conn = _omero_connection(credentials)
+        with imageio.OmeroImageReader(im_id, conn) as image_reader:
+            return batch.measure_to_sink(
+                sink, image_reader, image_decorr.measure, COLUMNS
+            )
+    except Exception as e:
+        print(f"Error {e} for image {im_id}", file=sys.stderr)
+        return 0
+
+
+def file_id(path):
+    """Returns an id for the file at `path`, stable across runs,
+    from a hash of its absolute path
+    """
+    digest = hashlib.sha1(os.path.abspath(path).encode()).digest()
+    # 53 bits, so that the id is exact even if cast to float
+    return int.from_bytes(digest[:8], "big") >> 11
+
+
+def _local_tasks(args):
+    metadata = {} if args.pixel_size is None else {"PhysicalSizeX": args.pixel_size}
+    # largest files first, so that no long image is left for the end
+    paths = sorted(args.files, key=os.path.getsize, reverse=True)
+    with imageio.FileImageReader(paths[0], metadata) as image_reader:
+        plane = image_reader.get_plane(0, 0, 0)
+    tasks = [
+        (path, dict(metadata, Id=file_id(path), Path=os.path.abspath(path)))
+        for path in paths
+    ]
+    return _measure_file, tasks, plane, metadata, None
+
+
+def _credentials(args):
+    return {
+        "user": args.user or input("OME login:"),
+        "password": os.environ.get("OMERO_PASSWORD") or getpass("OME password:"),
+        "host": args.host,
+        "port": args.port,
+    }
+
+
+def _omero_tasks(args):
+    credentials = _credentials(args)
+    metadatas = []
+    with _omero_connection(credentials) as conn:
+        conn.SERVICE_OPTS.setOmeroGroup("-1")
+        if args.ids:
+            images = conn.getObjects("Image", ids=args.ids)
+        else:
+            images = conn.getObjects("Image")
+        for im in images:
+            metadatas.append(
+                {
+                    "Id": im.getId(),
+                    "SizeX": im.getSizeX(),
+                    "SizeY": im.getSizeY(),
+                    "SizeZ": im.getSizeZ(),
+                    "SizeC": im.getSizeC(),
+                    "SizeT": im.getSizeT(),
+                }
+            )
+            if args.limit and len(metadatas) == args.limit:
+                break
+    if not metadatas:
+        return _measure_omero, [], None, {}, metadatas
+
+    conn = _omero_connection(credentials)
+    with imageio.OmeroImageReader(metadatas[0]["Id"], conn) as image_reader:
+        metadata = image_reader.get_metadata()
+        plane = image_reader.get_plane(0, 0, 0)
+    tasks = [(m["Id"], credentials) for m in metadatas]
+    return _measure_omero, tasks, plane, metadata, metadatas
+
+
+def _omero_reader(credentials, im_id):
+    return imageio.OmeroImageReader(im_id, _omero_connection(credentials))
+
+
+class MeasureTask:
+    """Measures one image for `batch.run_worker`
+
+    Parameters
+    ----------
+    open_reader : function
+        called with a queue item (an image id), returns an ImageReader
+    sink : a ResultSink instance
+    """
+
+    def __init__(self, open_reader, sink):
+        self.open_reader = open_reader
+        self.sink = sink
+
+    def __call__(self, item):
+        with self.open_reader(item) as image_reader:
+            return batch.measure_to_sink(
+                self.sink, image_reader, image_decorr.measure, COLUMNS
+            )
+
+
+def _run_queue_worker(path, task):
+    return batch.run_worker(batch.SQLiteWorkQueue(path), task)
+
+
+def enqueue(args):
+    """Adds OMERO image ids to the queue, listed from the server
+    unless they are given with --ids
+    """
+    ids = args.ids
+    if not ids:
+        credentials = _credentials(args)
+        with _omero_connection(credentials) as conn:
+            conn.SERVICE_OPTS.setOmeroGroup("-1")
+            ids = [im.getId() for im in conn.getObjects("Image")]
+        ids = ids[: args.limit] if args.limit else ids
+    queue = batch.SQLiteWorkQueue(args.queue)
+    queue.enqueue(ids)
+    print(f"Enqueued {len(ids)} images, queue status: {queue.counts()}")
+    return 0
+
+
+def work(args):
+    """Runs --workers processes measuring the images leased from the queue"""
+    batch.setup_logging(args.log_dir)
+    if args.output.endswith((".hf5", ".h5", ".hdf5")):
+        print(
+            "Workers on several hosts can not share a HDF5 file,"
+            " please give a directory for Parquet output",
+            file=sys.stderr,
+        )
+        return 1
+    workers = args.workers or 1
+    threads = args.threads or max((os.cpu_count() or 1) // workers, 1)
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(threads)
+    print(f"Using {workers} workers with {threads} threads each")
+
+    task = MeasureTask(
+        partial(_omero_reader, _credentials(args)),
+        batch.ParquetSink(args.output),
+    )
+    start = time.perf_counter()
+    with Pool(workers, initializer=_init_worker, initargs=(threads,)) as pool:
+        num_items = sum(pool.starmap(_run_queue_worker, [(args.queue, task)] * workers))
+    elapsed = time.perf_counter() - start
+    queue = batch.SQLiteWorkQueue(args.queue)
+    print(
+        f"Processed {num_items} images in {elapsed:.1f}s,"
+        f" queue status: {queue.counts()}"
+    )
+    return 0
+
+
+def _make_sink(output, manager):
+    if output.endswith((".hf5", ".h5", ".hdf5")):
+        return batch.HDFSink(output, manager.Lock())
+    return batch.ParquetSink(output)
+
+
+def run(args):
+    batch.setup_logging(args.log_dir)
+
+    make_tasks = _local_tasks if args.source == "local" else _omero_tasks
+    func, tasks, plane, metadata, metadatas = make_tasks(args)
+    if not tasks:
+        print("No image to measure")
+        return 0
+
+    if args.workers and args.threads:
+        workers, threads = args.workers, args.threads
+        plane_time = None
+        print(f"Using {workers} workers with {threads} threads each")
+    else:
+        if args.workers:
+            workers = args.workers
+            threads = max((os.cpu_count() or 1) // workers, 1)
+            plane_time = time_plane(plane, metadata, threads)
+        elif args.threads:
+            threads = args.threads
+            workers = max((os.cpu_count() or 1) // threads, 1)
+            plane_time = time_plane(plane, metadata, threads)
+        else:
+            workers, threads, plane_time = tune(plane, metadata)
+        print(
+            f"Using {workers} workers with {threads} threads each"
+            f" (calibration: {plane_time:.3f}s per plane)"
+        )
+
+    # only effective for libraries loaded after the fork,
+    # the others are capped by the worker initializer
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(threads)
+
+    manager = Manager()
+    sink = _make_sink(args.output, manager)
+    task_args = [(*task, sink) for task in tasks]
+
+    if metadatas is not None:
+        if plane_time is None:
+            plane_time = time_plane(plane, metadata, threads)
+        scheduler = batch.CostScheduler(workers, cost_model(plane, plane_time))
+        _, makespan = scheduler.plan(metadatas)
+        print(f"Expected makespan: {makespan:.0f}s")
+
+    start = time.perf_counter()
+    with Pool(workers, initializer=_init_worker, initargs=(threads,)) as pool:
+        if metadatas is not None:
+            results = scheduler.run(pool, func, task_args, metadatas)
+        else:
+            results = pool.starmap(func, task_args, chunksize=1)
+        num_records = sum(results)
+    if isinstance(sink, batch.HDFSink):
+        sink.refresh_rollups()
+    elapsed = time.perf_counter() - start
+    print(
+        f"Measured {num_records} planes from {len(tasks)} images"
+        f" in {elapsed:.1f}s ({num_records / elapsed:.2f} planes/s)"
+    )
+    return 0
+
+
+def _add_omero_arguments(parser, select=True):
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=4064)
+    parser.add_argument("--user", help="OMERO login (prompted if absent)")
+    if select:
+        parser.add_argument("--ids", type=int, nargs="+", help="ids of the images")
+        parser.add_argument("--limit", type=int, help="maximum number of images")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="auto-metro", description="Measures SNR and resolution of images in batch"
+    )
+    parser.add_argument(
+        "--output",
+        default="measures.hf5",
+        help="a .hf5 file, or a directory for Parquet output;"
+        " successive runs append to it",
+    )
+    parser.add_argument("--workers", type=int, help="number of worker processes")
+    parser.add_argument("--threads", type=int, help="number of threads per worker")
+    parser.add_argument(
+        "--log-dir",
+        help="directory of the log file, defaults to $MEASURE_LOG_DIRECTORY or .",
+    )
+    sources = parser.add_subparsers(dest="source", required=True)
+
+    local = sources.add_parser("local", help="measure local image files")
+    local.add_argument("files", nargs="+")
+    local.add_argument(
+        "--pixel-size",
+        type=float,
+        help="pixel size in µm, the resolution is given in pixels if absent",
+    )
+
+    omero = sources.add_parser("omero", help="measure images from an OMERO server")
+    _add_omero_arguments(omero)
+
+    enqueue_parser = sources.add_parser(
+        "enqueue", help="add OMERO images to a work queue"
+    )
+    enqueue_parser.add_argument("queue", help="the SQLite queue file")
+    _add_omero_arguments(enqueue_parser)
+
+    worker = sources.add_parser(
+        "worker", help="measure the images of a work queue, on any host"
+    )
+    worker.add_argument("queue", help="the SQLite queue file")
+    _add_omero_arguments(worker, select=False)
+
+    args = parser.parse_args(argv)
+    if args.source == "enqueue":
+        return enqueue(args)
+    if args.source == "worker":
+        return work(args)
+    return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
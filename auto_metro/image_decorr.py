@@ -12,12 +12,12 @@ Original source code in matlab™ and ImageJ plugin are available at https://git
 import warnings
 
 import numpy as np
-import matplotlib.pyplot as plt
 
 from scipy.ndimage import gaussian_filter
 from scipy.optimize import minimize_scalar
 
 from .utils import apodise, _fft, _ifft
+from .metrics import METRICS
 
 
 def measure(image, metadata):
@@ -32,18 +32,29 @@ def measure(image, metadata):
     Parameters
     ----------
     image : the 2D image to be evaluated
-    metadata : image metadata (the key physicalSizeX will be use as pixel size)
+    metadata : image metadata (the key physicalSizeX, or PhysicalSizeX as set
+        by the image readers, will be use as pixel size, and PhysicalSizeXUnit
+        as its unit, µm by default)
 
     Returns
     -------
     measured_data : dict
-        the evaluated SNR and resolution
+        the evaluated SNR and resolution, and the unit of the resolution,
+        "pixel" if the metadata has no pixel size
 
     """
-    pixel_size = metadata.get("physicalSizeX", 1.0)
+    pixel_size = metadata.get("physicalSizeX", metadata.get("PhysicalSizeX"))
+    if pixel_size is None:
+        pixel_size, unit = 1.0, "pixel"
+    else:
+        unit = metadata.get("PhysicalSizeXUnit", "µm")
     imdecor = ImageDecorr(image, pixel_size)
     imdecor.compute_resolution()
-    return {"SNR": imdecor.snr0, "resolution": imdecor.resolution}
+    return {
+        "SNR": imdecor.snr0,
+        "resolution": imdecor.resolution,
+        "resolution_unit": unit,
+    }
 
 
 class ImageDecorr:
@@ -94,6 +105,7 @@ class ImageDecorr:
         self.snr0, self.kc0 = self.maximize_corcoef(self.im_fftr).values()  # A0, res0
         self.max_width = 2 / self.kc0
         self.kc = None
+        self.width = None
         self.resolution = None
 
     def corcoef(self, radius, im_fftr, c1=None):
@@ -127,6 +139,8 @@ class ImageDecorr:
         res = minimize_scalar(
             anti_cor, bounds=(r_min, r_max), method="bounded", options={"xatol": 1e-4}
         )
+        METRICS.count("corcoef_nit", res.nit)
+        METRICS.count("corcoef_nfev", res.nfev)
 
         if not res.success:
             return {"snr": 0.0, "kc": 1.0}
@@ -212,18 +226,10 @@ class ImageDecorr:
     def compute_resolution(self):
         """Finds the filter width giving the maximum of the geometric
         mean (kc * snr)**0.5 (eq. 2)
-
-
         """
-
-        res = minimize_scalar(
-            self.filtered_decorr,
-            method="bounded",
-            bounds=(0.15, self.max_width),
-            options={"xatol": 1e-3},
-        )
-        width = res.x
-        max_cor = self.filtered_decorr(width, returm_gm=False)
+        res = self._minimize_width((0.15, self.max_width))
+        self.width = res.x
+        max_cor = self.filtered_decorr(self.width, returm_gm=False)
 
         self.kc = max_cor["kc"]
         if self.kc:
@@ -232,6 +238,17 @@ class ImageDecorr:
             self.resolution = np.inf
         return res, max_cor
 
+    def _minimize_width(self, bounds):
+        res = minimize_scalar(
+            self.filtered_decorr,
+            method="bounded",
+            bounds=bounds,
+            options={"xatol": 1e-3},
+        )
+        METRICS.count("width_nit", res.nit)
+        METRICS.count("width_nfev", res.nfev)
+        return res
+
 
 def _masked_fft(im, mask, size):
     return (mask * _fft(im)).ravel()[: size // 2]
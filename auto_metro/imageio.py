@@ -1,6 +1,11 @@
+import os
+import string
+from datetime import datetime
 import numpy as np
 from itertools import product
 
+from .metrics import METRICS
+
 
 class ImageReader:
     """Abstract class defining an image reader for the metrology
@@ -17,6 +22,7 @@ class ImageReader:
         "AquisitionDate": "2000-01-01T00:00:00",
         "LensNA": 1.0,
         "PhysicalSizeX": 1.0,
+        "PhysicalSizeXUnit": "pixel",
         "nominalMagnification": 10.0,
         "ChannelLabels": ["R", "G", "B"],
     }
@@ -41,7 +47,9 @@ class ImageReader:
         size_z = self.metadata["SizeZ"]
         size_t = self.metadata["SizeT"]
         for czt in product(range(size_c), range(size_z), range(size_t)):
-            yield czt, self.get_plane(*czt)
+            with METRICS.timer("read"):
+                plane = self.get_plane(*czt)
+            yield czt, plane
 
     def __exit__(self, exc_type, exc_value, traceback):
         raise NotImplementedError
@@ -111,12 +119,15 @@ class OmeroImageReader(ImageReader):
         """Returns a dictionnary with the image metadata
         with keys:
 
+        * "SizeX"
+        * "SizeY"
         * "SizeZ"
         * "SizeC"
         * "SizeT"
         * "Id"
         * "AquisitionDate"
         * "PhysicalSizeX"
+        * "PhysicalSizeXUnit"
         * "ChannelLabels"
         * "LensNA"
         * "nominalMagnification"
@@ -138,12 +149,15 @@ class OmeroImageReader(ImageReader):
 
         sizex = self.pixels.getPhysicalSizeX()
         metadata = {
+            "SizeX": self.image.getSizeX(),
+            "SizeY": self.image.getSizeY(),
             "SizeZ": self.image.getSizeZ(),
             "SizeC": self.image.getSizeC(),
             "SizeT": self.image.getSizeT(),
             "Id": self.image.getId(),
             "AquisitionDate": self.image.getAcquisitionDate().isoformat(),
             "PhysicalSizeX": sizex.getValue(),
+            "PhysicalSizeXUnit": sizex.getSymbol(),
             "ChannelLabels": self.image.getChannelLabels(),
         }
         if obj:
@@ -165,3 +179,131 @@ class OmeroImageReader(ImageReader):
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.conn.close()
+
+
+class ArrayImageReader(ImageReader):
+    """Image reader for an image already loaded in memory
+
+    Parameters
+    ----------
+    image : np.ndarray
+        the image, with the dimensions ordered as (C, Z, T, Y, X),
+        the missing leading dimensions are set to 1, so a single
+        2D plane can be passed as is
+    metadata : dict, optional
+        metadata updating `ImageReader.minimal_metadata`, the sizes
+        are set from the array shape. A "PhysicalSizeX" given without
+        "PhysicalSizeXUnit" is taken in µm
+    axes : str, optional
+        the order of the image dimensions, as a string made of the letters
+        "CZTYX" (and "S" for the RGB samples, read as channels), e.g. "ZYX"
+        for a z-stack, the image is transposed to (C, Z, T, Y, X)
+
+    Usage
+    -----
+
+    .. code-block:: python
+        with imageio.ArrayImageReader(stack, {"PhysicalSizeX": 0.2}) as image_reader:
+            data = batch.measure_single(image_reader, image_decorr.measure, columns)
+
+    """
+
+    def __init__(self, image, metadata=None, axes=None):
+        image = np.asarray(image)
+        if axes is not None:
+            image = _to_czt(image, axes)
+        if not 2 <= image.ndim <= 5:
+            raise ValueError(
+                f"Expected an image with 2 to 5 dimensions, got {image.ndim}"
+            )
+        self.extra_metadata = metadata or {}
+        super().__init__(image.reshape((1,) * (5 - image.ndim) + image.shape))
+        self.id = self.metadata["Id"]
+
+    def get_metadata(self):
+        size_c, size_z, size_t, size_y, size_x = self.image.shape
+        metadata = dict(self.minimal_metadata)
+        if "PhysicalSizeX" in self.extra_metadata:
+            metadata["PhysicalSizeXUnit"] = "µm"
+        metadata.update(self.extra_metadata)
+        metadata.update(
+            {
+                "SizeX": size_x,
+                "SizeY": size_y,
+                "SizeZ": size_z,
+                "SizeC": size_c,
+                "SizeT": size_t,
+            }
+        )
+        if len(metadata["ChannelLabels"]) < size_c:
+            metadata["ChannelLabels"] = list(string.ascii_uppercase[:size_c])
+        return metadata
+
+    def get_plane(self, c, z, t):
+        return self.image[c, z, t]
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+def _to_czt(image, axes):
+    """Transposes image with the given axes to (C, Z, T, Y, X)
+    """
+    axes = axes.upper().replace("S", "C")
+    if (
+        len(axes) != image.ndim
+        or len(set(axes)) != len(axes)
+        or not set(axes) <= set("CZTYX")
+        or not {"Y", "X"} <= set(axes)
+    ):
+        raise ValueError(
+            f"Unsupported axes {axes} for an image of shape {image.shape}"
+        )
+    for ax in "CZTYX":
+        if ax not in axes:
+            image = image[np.newaxis]
+            axes = ax + axes
+    return np.transpose(image, [axes.index(ax) for ax in "CZTYX"])
+
+
+def _read_file(path):
+    """Returns the image in path and its axes
+    """
+    if str(path).lower().endswith((".tif", ".tiff")):
+        import tifffile
+
+        with tifffile.TiffFile(path) as tif:
+            series = tif.series[0]
+            return series.asarray(), series.axes
+
+    from skimage.io import imread
+
+    image = imread(path)
+    if image.ndim == 3 and image.shape[-1] in (3, 4):
+        return image, "YXS"
+    return image, "YX"
+
+
+class FileImageReader(ArrayImageReader):
+    """Image reader for a local image file
+
+    TIFF files are read with `tifffile`, and their dimensions are taken
+    from the file axes (e.g. "ZYX" for a z-stack). Other formats are read with
+    `skimage.io.imread`, and must be 2D planes or RGB(A) images.
+    The acquisition date is the file modification time.
+
+    Parameters
+    ----------
+    path : str, the image file path
+    metadata : dict, optional, passed to `ArrayImageReader`
+    """
+
+    def __init__(self, path, metadata=None):
+        self.path = path
+        metadata = dict(metadata or {})
+        metadata.setdefault(
+            "AquisitionDate",
+            datetime.fromtimestamp(os.path.getmtime(path)).isoformat(),
+        )
+        image, axes = _read_file(path)
+        super().__init__(image, metadata, axes=axes)
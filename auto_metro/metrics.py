@@ -0,0 +1,135 @@
+"""Lightweight instrumentation of the measure pipeline
+
+The module level `METRICS` instance accumulates the wall time spent in
+each stage (image reading, FFTs, measure, HDF5 writes) and the optimizer
+iteration and function evaluation counts. Each call to `METRICS.record`
+closes a row with the values accumulated since the previous call.
+
+Instrumentation is disabled by default, and enabled either by setting
+the `AUTO_METRO_METRICS` environment variable to 1 (which is inherited by
+the pool workers), or with `METRICS.enabled = True`.
+
+Usage
+-----
+
+.. code-block:: python
+
+    from auto_metro.metrics import METRICS
+
+    METRICS.enabled = True
+    with METRICS.timer("read"):
+        plane = image_reader.get_plane(0, 0, 0)
+    METRICS.count("nfev", 12)
+    METRICS.record(Id=image_reader.id, C=0, Z=0, T=0)
+    data = METRICS.to_frame()
+
+"""
+import os
+import socket
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+LABELS = ["worker", "kind", "Id", "C", "Z", "T", "planes"]
+STAGES = ["read", "fft", "measure", "lock", "write"]
+COUNTS = [
+    "corcoef_nit",
+    "corcoef_nfev",
+    "width_nit",
+    "width_nfev",
+    "psf_nit",
+    "psf_nfev",
+]
+COLUMNS = LABELS + STAGES + COUNTS
+
+
+class Metrics:
+    """Accumulates stage timings and counts, see the module docstring
+
+    Attributes
+    ----------
+    enabled : bool
+    records : list of dict, the closed records
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.records = []
+        self._current = defaultdict(float)
+
+    @property
+    def worker(self):
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    @contextmanager
+    def timer(self, stage):
+        """Context manager adding the time spent in the block to `stage`
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._current[stage] += time.perf_counter() - start
+
+    def count(self, key, value=1):
+        """Adds value to the counter `key`
+        """
+        if self.enabled:
+            self._current[key] += value
+
+    def record(self, kind="plane", **labels):
+        """Closes the current record, with the labels passed as keyword arguments
+        """
+        if not self.enabled:
+            return
+        row = {"worker": self.worker, "kind": kind}
+        row.update(labels)
+        row.update(self._current)
+        self.records.append(row)
+        self._current.clear()
+
+    def discard(self):
+        """Drops the values accumulated since the last record
+        """
+        self._current.clear()
+
+    def to_frame(self, reset=True):
+        """Returns the closed records as a DataFrame with at least
+        the columns in `COLUMNS`, empty if no record was closed
+
+        If reset is True, the records are cleared.
+        """
+        # pandas is not needed on the measure path
+        import pandas as pd
+
+        data = pd.DataFrame.from_records(self.records)
+        extra = [col for col in data.columns if col not in COLUMNS]
+        data = data.reindex(columns=COLUMNS + extra)
+        for col in STAGES + COUNTS:
+            data[col] = data[col].astype(float).fillna(0.0)
+        if reset:
+            self.records = []
+        return data
+
+
+def summarize(data):
+    """Aggregates a metrics table per worker
+
+    Returns
+    -------
+    summary : pd.DataFrame
+        the total time in each stage, the total counts and
+        the number of planes per second, indexed by worker
+    """
+    summary = data.groupby("worker")[STAGES + COUNTS].sum()
+    summary["planes"] = (data["kind"] == "plane").groupby(data["worker"]).sum()
+    # the fft stage is nested in the measure stage
+    wall = summary[["read", "measure", "lock", "write"]].sum(axis=1)
+    summary["throughput"] = summary["planes"] / wall.where(wall > 0)
+    return summary
+
+
+METRICS = Metrics(enabled=os.environ.get("AUTO_METRO_METRICS", "0") == "1")
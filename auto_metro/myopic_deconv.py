@@ -11,6 +11,7 @@ from scipy.optimize import minimize
 
 from .utils import fft_dist, _fft
 from .zernike import zernike_nm, MODES, MODE_NAMES
+from .metrics import METRICS
 
 
 def zernike_tf(rho, phi, resolution, mode_amps, modes=None):
@@ -122,6 +123,8 @@ def estimate_psf(
         p0 = [val for k, val in initial.items() if k != "resolution"]
 
     res = minimize(opt_gml, p0, **min_kwargs)
+    METRICS.count("psf_nit", res.get("nit", 0))
+    METRICS.count("psf_nfev", res.nfev)
 
     if fit_resolution:
         alpha, beta, resolution, *amps = res.x
@@ -1,19 +1,33 @@
 import numpy as np
 
 from scipy.fft import fftn, fftshift, ifftn, ifftshift
-from scipy.signal import general_gaussian
+
+from .metrics import METRICS
 
 
 def _fft(image):
     """shifted fft 2D
     """
-    return fftshift(fftn(fftshift(image)))
+    with METRICS.timer("fft"):
+        return fftshift(fftn(fftshift(image)))
 
 
 def _ifft(im_fft):
     """shifted ifft 2D
     """
-    return ifftshift(ifftn(ifftshift(im_fft)))
+    with METRICS.timer("fft"):
+        return ifftshift(ifftn(ifftshift(im_fft)))
+
+
+def general_gaussian(M, p, sig):
+    """Returns a window with a generalized Gaussian shape,
+    same as `scipy.signal.windows.general_gaussian`, which is not
+    used to avoid importing scipy.signal at start-up
+
+    w(n) = exp(-0.5 * |(n - (M - 1) / 2) / sig|**(2 * p))
+    """
+    n = np.arange(M) - (M - 1.0) / 2.0
+    return np.exp(-0.5 * np.abs(n / sig) ** (2 * p))
 
 
 # apodImRect.m
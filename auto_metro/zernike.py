@@ -1,7 +1,6 @@
 """Zernike polynomials
 """
 import numpy as np
-import matplotlib.pyplot as plt
 from math import factorial
 from numpy.polynomial import Polynomial
 
@@ -95,6 +94,9 @@ def show_zern(n, m, grid_size):
     """Draws a polar representation of the Zernike polynomial
     of degree n, m with grid_size by grid_size samples.
     """
+    # imported here to keep matplotlib out of the workers start-up
+    import matplotlib.pyplot as plt
+
     rho, phi = np.meshgrid(
         np.linspace(0, 1, grid_size), np.linspace(-np.pi, np.pi, grid_size)
     )
@@ -0,0 +1,237 @@
+"""Benchmarks of the decorrelation, PSF and batch hot paths
+
+Times `image_decorr.measure`, `ImageDecorr.compute_resolution`,
+`ImageDecorr.all_corcoefs`, `myopic_deconv.estimate_psf` and
+`batch.measure_single` over an `ArrayImageReader`, on synthetic images
+and on the bundled samples, records the peak memory of each call and
+checks the results against reference values.
+
+Usage
+-----
+
+.. code-block:: sh
+
+    # from the repository root
+    python benchmarks/bench_hot_paths.py --sizes 256 512 1024 --save-baseline ref.json
+    # after some optimisation work
+    python benchmarks/bench_hot_paths.py --sizes 256 512 1024 --baseline ref.json
+
+The script exits with a non zero status if a result does not match
+its reference value.
+"""
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy.ndimage import gaussian_filter
+from skimage import img_as_float
+from skimage.io import imread
+
+from auto_metro import batch, image_decorr, imageio, myopic_deconv
+
+SAMPLES = Path(__file__).parent.parent / "samples"
+SIZES = [256, 512, 1024, 2048, 4096]
+
+# Reference values for the samples (checked to 2 significant digits)
+REFERENCES = {
+    "corti00/measure": {"SNR": 0.6, "resolution": 1.8},
+}
+SAMPLE_METADATA = {
+    "corti00": {"physicalSizeX": 0.3},
+}
+
+COLUMNS = [
+    "Id",
+    "AquisitionDate",
+    "LensNA",
+    "ChannelLabel",
+    "PhysicalSizeX",
+    "C",
+    "Z",
+    "T",
+    "SNR",
+    "resolution",
+    "resolution_unit",
+]
+PSF_MODES = [(2, -2), (2, 2), (4, 0)]
+
+
+def synthetic_image(size, seed=0, sigma=2.0, density=1e-3):
+    """Returns a size x size image of blurred point emitters
+    with Poisson noise, normalized to [0, 1]
+    """
+    rng = np.random.default_rng(seed)
+    image = np.zeros((size, size))
+    num_points = int(density * size ** 2)
+    image[rng.integers(0, size, num_points), rng.integers(0, size, num_points)] = (
+        rng.uniform(50, 200, num_points)
+    )
+    image = gaussian_filter(image, sigma) * 2 * np.pi * sigma ** 2
+    image = rng.poisson(image + 10).astype(float)
+    return image / image.max()
+
+
+def load_images(sizes):
+    images = {f"synthetic_{size}": (synthetic_image(size), {}) for size in sizes}
+    for path in sorted(SAMPLES.glob("*.tif*")):
+        try:
+            image = img_as_float(imread(path))
+        except Exception as e:
+            print(f"Skipping {path.name}: {e}", file=sys.stderr)
+            continue
+        if image.ndim != 2:
+            print(f"Skipping {path.name}: not a 2D image", file=sys.stderr)
+            continue
+        images[path.stem] = (image, SAMPLE_METADATA.get(path.stem, {}))
+    return images
+
+
+def bench_measure(image, metadata):
+    measured = image_decorr.measure(image, metadata)
+    return {"SNR": measured["SNR"], "resolution": measured["resolution"]}
+
+
+def bench_compute_resolution(imdecor):
+    imdecor.compute_resolution()
+    return {"kc": imdecor.kc, "resolution": imdecor.resolution}
+
+
+def bench_all_corcoefs(imdecor):
+    data = imdecor.all_corcoefs(num_rs=50, num_ws=10)
+    return {"snr": data["snr"].max(), "kc": data["kc"].max()}
+
+
+def bench_estimate_psf(image):
+    _, params = myopic_deconv.estimate_psf(
+        image, modes=PSF_MODES, options={"maxiter": 20}
+    )
+    return {"alpha": params["alpha"], "beta": params["beta"]}
+
+
+def bench_measure_single(image, metadata):
+    stack = np.stack([image, image[::-1], image[:, ::-1], image[::-1, ::-1]])
+    image_reader = imageio.ArrayImageReader(
+        stack[:, np.newaxis], {"PhysicalSizeX": metadata.get("physicalSizeX", 1.0)}
+    )
+    data = batch.measure_single(image_reader, image_decorr.measure, COLUMNS)
+    return {"resolution": data["resolution"].median()}
+
+
+def time_call(func, args, repeat):
+    """Returns the result, the timings and the peak traced memory of func(*args)
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, timings, peak
+
+
+def run(sizes, repeat=3, psf_max_size=1024):
+    records = []
+    for name, (image, metadata) in load_images(sizes).items():
+        imdecor = image_decorr.ImageDecorr(image, metadata.get("physicalSizeX", 1.0))
+        cases = {
+            "measure": (bench_measure, (image, metadata)),
+            "compute_resolution": (bench_compute_resolution, (imdecor,)),
+            "all_corcoefs": (bench_all_corcoefs, (imdecor,)),
+            "measure_single": (bench_measure_single, (image, metadata)),
+        }
+        if max(image.shape) <= psf_max_size:
+            cases["estimate_psf"] = (bench_estimate_psf, (image,))
+
+        for bench, (func, args) in cases.items():
+            result, timings, peak = time_call(func, args, repeat)
+            print(f"{name:>16} {bench:>20}: {min(timings):.3f}s", file=sys.stderr)
+            records.append(
+                {
+                    "image": name,
+                    "shape": "x".join(str(s) for s in image.shape),
+                    "bench": bench,
+                    "time_min": min(timings),
+                    "time_median": np.median(timings),
+                    "peak_mib": peak / 2 ** 20,
+                    "values": {k: float(v) for k, v in result.items()},
+                }
+            )
+    return pd.DataFrame.from_records(records)
+
+
+def check(results, baseline=None, rtol=1e-3):
+    """Compares the values of each benchmark with the built-in references
+    and the baseline values
+
+    Returns
+    -------
+    mismatches : list of str
+    """
+    mismatches = []
+    for _, row in results.iterrows():
+        key = f"{row['image']}/{row['bench']}"
+        for name, value in REFERENCES.get(key, {}).items():
+            try:
+                np.testing.assert_approx_equal(row["values"][name], value, 2)
+            except AssertionError:
+                mismatches.append(f"{key} {name}: {row['values'][name]} != {value}")
+        if baseline is None or key not in baseline:
+            continue
+        for name, value in baseline[key].items():
+            if not np.isclose(row["values"][name], value, rtol=rtol, equal_nan=True):
+                mismatches.append(f"{key} {name}: {row['values'][name]} != {value}")
+    return mismatches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--psf-max-size",
+        type=int,
+        default=1024,
+        help="skip estimate_psf for larger images",
+    )
+    parser.add_argument("--baseline", help="json file with the reference values")
+    parser.add_argument(
+        "--save-baseline", help="write the computed values to this json file"
+    )
+    parser.add_argument("--rtol", type=float, default=1e-3)
+    parser.add_argument("--output", help="write the timings to this csv file")
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.repeat, args.psf_max_size)
+    print(results.drop(columns="values").to_string(index=False))
+    if args.output:
+        results.to_csv(args.output, index=False)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+    if args.save_baseline:
+        values = {
+            f"{row['image']}/{row['bench']}": row["values"]
+            for _, row in results.iterrows()
+        }
+        with open(args.save_baseline, "w") as fh:
+            json.dump(values, fh, indent=2)
+
+    mismatches = check(results, baseline, args.rtol)
+    for mismatch in mismatches:
+        print(f"MISMATCH {mismatch}", file=sys.stderr)
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,10 @@
+import os
 import sys
 import traceback
 import random
 from multiprocessing import Pool, Lock, Manager
-from datetime import date
-from getpass import getpass
 import pandas as pd
+from getpass import getpass
 import omero
 import omero.clients
 from omero.gateway import BlitzGateway
@@ -14,6 +14,8 @@ from omero_utils.images import get_images_from_instrument
 
 host = "localhost"
 port = 4064
+num_workers = 6
+timings_file = "timings.csv"
 columns = [
     "Id",
     "AquisitionDate",
@@ -25,29 +27,36 @@ columns = [
     "T",
     "SNR",
     "resolution",
+    "resolution_unit",
 ]
 
 
+def results_file(instrument_id):
+    # a single store per instrument, so that the daily rollups span all the runs
+    return f"measures_{instrument_id}.hf5"
+
+
 def target(lock, im_id, credentials):
     try:
-        hf5_record = f"measures_{instrument_id}_{date.today().isoformat()}.hf5"
+        hf5_record = results_file(instrument_id)
         conn = BlitzGateway(
             credentials["loggin"], credentials["password"], host=host, port=port
         )
         # Allow connection to all the images
         with imageio.OmeroImageReader(im_id, conn) as image_reader:
-            data = batch.measure_process(
+            num_records = batch.measure_process(
                 lock, hf5_record, image_reader, image_decorr.measure, columns
             )
-            return data
+            return num_records
     except Exception as e:
         _, _, tb = sys.exc_info()
         print(f"Erro {e} for {im_id}")
         traceback.print_tb(tb)
-        return pd.DataFrame(columns=columns)
+        return 0
 
 def main(instrument_id):
 
+    batch.setup_logging()
     loggin = input("OME loggin:")
     password = getpass("OME password:")
     credentials = {"loggin": loggin, "password": password}
@@ -59,18 +68,43 @@ def main(instrument_id):
         conn.SERVICE_OPTS.setOmeroGroup("-1")
         print(instrument_id)
         #all_images = get_images_from_instrument(instrument_id, conn)
-        all_images = [im.id for im in conn.getObjects("Image")]
+        images = list(conn.getObjects("Image"))
 
-        random.shuffle(all_images)
-        all_images = all_images[:1000]
+        # a random sample of the images, the scheduler only sets their order
+        random.shuffle(images)
+        images = images[:1000]
+        all_images = [im.id for im in images]
+        metadatas = [
+            {
+                "SizeX": im.getSizeX(),
+                "SizeY": im.getSizeY(),
+                "SizeZ": im.getSizeZ(),
+                "SizeC": im.getSizeC(),
+                "SizeT": im.getSizeT(),
+            }
+            for im in images
+        ]
         print(f"There are {len(all_images)} images to analyse")
 
-    pool = Pool(6)
-    results = pool.starmap_async(
-        target, [(lock, im_id, credentials) for im_id in all_images]
-    )
-    results.get()
+    scheduler = batch.CostScheduler(num_workers)
+    if os.path.exists(timings_file):
+        past = pd.read_csv(timings_file)
+        scheduler.cost_model.fit(past["work"], past["time"])
+    _, makespan = scheduler.plan(metadatas)
+    print(f"Expected makespan: {makespan / 3600:.2f} h")
 
+    with Pool(num_workers) as pool:
+        for _ in scheduler.run(
+            pool,
+            target,
+            [(lock, im_id, credentials) for im_id in all_images],
+            metadatas,
+        ):
+            pass
+    batch.HDFSink(results_file(instrument_id), lock).refresh_rollups()
+    scheduler.timings.to_csv(
+        timings_file, mode="a", header=not os.path.exists(timings_file), index=False
+    )
 
 if __name__ == "__main__":
 
@@ -7,5 +7,7 @@ setup(
     author_email="guillaume@damcb.com",
     description="QA assesment tools for fluorescence microscopy",
     long_description="",
+    packages=["auto_metro"],
+    entry_points={"console_scripts": ["auto-metro=auto_metro.cli:main"]},
     zip_safe=True,
 )
@@ -0,0 +1,387 @@
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from auto_metro import batch, metrics
+from auto_metro.metrics import METRICS
+from auto_metro.imageio import ArrayImageReader
+
+columns = [
+    "Id",
+    "AquisitionDate",
+    "LensNA",
+    "ChannelLabel",
+    "PhysicalSizeX",
+    "C",
+    "Z",
+    "T",
+    "mean",
+]
+
+
+def mean_measure(plane, metadata):
+    return {"mean": plane.mean()}
+
+
+def make_reader():
+    stack = np.arange(2 * 3 * 4, dtype=float).reshape((2, 3, 4, 1, 1))
+    return ArrayImageReader(stack)
+
+
+def test_measure_iter():
+    chunks = list(batch.measure_iter(make_reader(), mean_measure, columns, chunksize=5))
+    assert [chunk.shape[0] for chunk in chunks] == [5, 5, 5, 5, 4]
+    data = pd.concat(chunks)
+    np.testing.assert_array_equal(data["mean"], np.arange(24))
+    np.testing.assert_array_equal(data.index, np.arange(24))
+    assert data.loc[23, "ChannelLabel"] == "G"
+    np.testing.assert_array_equal(data.loc[23, ["C", "Z", "T"]], [1, 2, 3])
+
+
+def test_measure_single():
+    data = batch.measure_single(make_reader(), mean_measure, columns)
+    assert list(data.columns) == columns
+    assert data.shape == (24, len(columns))
+    assert data["AquisitionDate"].dtype.kind == "M"
+
+
+def test_measure_single_no_id():
+    image_reader = make_reader()
+    metadata = image_reader.get_metadata()
+    del metadata["Id"]
+    image_reader.get_metadata = lambda: metadata
+    data = batch.measure_single(image_reader, mean_measure, columns)
+    assert data.shape == (24, len(columns))
+    assert data["Id"].isna().all()
+
+
+def test_measure_process(tmp_path):
+    hf5_record = tmp_path / "measures.hf5"
+    num_records = batch.measure_process(
+        threading.Lock(), hf5_record, make_reader(), mean_measure, columns, chunksize=7
+    )
+    assert num_records == 24
+    data = pd.read_hdf(hf5_record, "test_batch")
+    np.testing.assert_array_equal(data["mean"], np.arange(24))
+
+    # a second run appends to the same store, the rollups cover both
+    batch.measure_process(
+        threading.Lock(), hf5_record, make_reader(), mean_measure, columns
+    )
+    store = batch.ResultsStore(hf5_record)
+    assert store.refresh_rollups() == 1
+    assert store.rollup("test_batch")["count"].sum() == 48
+
+
+def test_cost_model_fit():
+    works = np.array([1e6, 2e6, 4e6, 8e6])
+    model = batch.CostModel().fit(works, 2.0 + 1e-6 * works)
+    np.testing.assert_almost_equal(model.rate, 1e-6)
+    np.testing.assert_almost_equal(model.overhead, 2.0)
+
+    small = batch.image_work(
+        {"SizeX": 256, "SizeY": 256, "SizeZ": 1, "SizeC": 1, "SizeT": 1}
+    )
+    large = batch.image_work(
+        {"SizeX": 256, "SizeY": 256, "SizeZ": 10, "SizeC": 1, "SizeT": 1}
+    )
+    assert large == 10 * small
+
+
+def test_expected_makespan():
+    assert batch.expected_makespan([5, 4, 3, 3, 3], 2) == 10
+    assert batch.expected_makespan([3], 4) == 3
+    assert batch.expected_makespan([], 4) == 0
+
+
+def square(x):
+    return x**2
+
+
+def test_cost_scheduler():
+    from multiprocessing import Pool
+
+    metadatas = [
+        {"SizeX": 64, "SizeY": 64, "SizeZ": z, "SizeC": 1, "SizeT": 1}
+        for z in (1, 20, 5)
+    ]
+    scheduler = batch.CostScheduler(num_workers=2)
+    order, makespan = scheduler.plan(metadatas)
+    np.testing.assert_array_equal(order, [1, 2, 0])
+    assert makespan > 0
+
+    with Pool(2) as pool:
+        results = list(scheduler.run(pool, square, [(0,), (1,), (2,)], metadatas))
+    assert sorted(results) == [0, 1, 4]
+    assert scheduler.timings.shape == (3, 3)
+
+
+def test_sqlite_queue_lease(tmp_path):
+    queue = batch.SQLiteWorkQueue(tmp_path / "queue.db", lease_timeout=0.1)
+    queue.enqueue([3, 1, 2])
+    queue.enqueue([1])
+    assert queue.counts()["pending"] == 3
+
+    assert queue.lease("w0") == 1
+    assert queue.heartbeat(1, "w0")
+    assert not queue.heartbeat(1, "w1")
+    assert queue.lease("w1") == 2
+    time.sleep(0.2)
+    # expired lease is handed to another worker
+    assert queue.lease("w2") == 1
+    assert not queue.complete(1, "w0")
+    assert queue.complete(1, "w2", {"n": 4})
+    assert queue.fail(2, "w1", "boom")
+    assert queue.counts() == {"pending": 2, "leased": 0, "done": 1, "failed": 0}
+    assert queue.results().loc[1, "result"] == {"n": 4}
+
+
+def test_sqlite_queue_failures(tmp_path):
+    queue = batch.SQLiteWorkQueue(tmp_path / "queue.db", max_attempts=2)
+    queue.enqueue([0])
+    for _ in range(2):
+        assert queue.lease("w0") == 0
+        queue.fail(0, "w0", "boom")
+    assert queue.lease("w0") is None
+    assert queue.counts()["failed"] == 1
+
+
+def _run_worker(path):
+    queue = batch.SQLiteWorkQueue(path)
+    return batch.run_worker(queue, square)
+
+
+def test_run_worker(tmp_path):
+    from multiprocessing import Pool
+
+    path = tmp_path / "queue.db"
+    queue = batch.SQLiteWorkQueue(path)
+    queue.enqueue(range(40))
+    with Pool(4) as pool:
+        num_items = pool.map(_run_worker, [path] * 4)
+
+    assert sum(num_items) == 40
+    results = queue.results()
+    assert (results["status"] == "done").all()
+    assert (results["attempts"] == 1).all()
+    assert results.loc[7, "result"] == 49
+
+
+def test_run_worker_expired_lease(tmp_path):
+    queue = batch.SQLiteWorkQueue(tmp_path / "queue.db", lease_timeout=0.5)
+    queue.enqueue([1, 2, 3])
+    # a worker crashes while holding a lease
+    assert queue.lease("crashed") == 1
+    assert queue.next_expiry() > time.time()
+
+    start = time.perf_counter()
+    assert batch.run_worker(queue, square, worker="w0", poll_interval=0.1) == 3
+    assert time.perf_counter() - start >= 0.4
+    results = queue.results()
+    assert (results["status"] == "done").all()
+    assert results.loc[1, "worker"] == "w0"
+    assert results.loc[1, "attempts"] == 2
+    assert queue.next_expiry() is None
+
+
+def test_setup_logging(tmp_path):
+    first = batch.setup_logging(tmp_path)
+    assert batch.setup_logging(tmp_path) is first
+    (tmp_path / "other").mkdir()
+    other = batch.setup_logging(tmp_path / "other")
+    # the previous file is closed and detached
+    assert first.stream is None
+    assert batch.log.handlers == [other]
+    batch.log.removeHandler(other)
+    other.close()
+
+
+def test_measure_process_metrics(tmp_path):
+    hf5_record = tmp_path / "measures.hf5"
+    METRICS.enabled = True
+    try:
+        batch.measure_process(
+            threading.Lock(),
+            hf5_record,
+            make_reader(),
+            mean_measure,
+            columns,
+            chunksize=10,
+        )
+        leftover = dict(METRICS._current)
+    finally:
+        METRICS.enabled = False
+
+    assert not leftover
+    data = pd.read_hdf(hf5_record, "test_batch_metrics")
+    assert list(data.columns) == metrics.COLUMNS
+    assert (data["kind"] == "plane").sum() == 24
+    assert (data["kind"] == "write").sum() == 3
+    assert (data["measure"] >= 0).all()
+    assert data.loc[data["kind"] == "write", "planes"].sum() == 24
+
+    summary = metrics.summarize(data)
+    assert summary.shape[0] == 1
+    assert summary["planes"].iloc[0] == 24
+
+
+def test_metrics_counts():
+    from auto_metro.image_decorr import measure
+
+    image = np.random.default_rng(0).random((64, 64))
+    METRICS.enabled = True
+    try:
+        measure(image, {})
+        METRICS.record(Id=0)
+        data = METRICS.to_frame()
+    finally:
+        METRICS.enabled = False
+    assert data.loc[0, "fft"] > 0
+    assert data.loc[0, "width_nfev"] > 0
+    assert data.loc[0, "corcoef_nfev"] > data.loc[0, "width_nfev"]
+
+
+def test_array_image_reader():
+    image_reader = ArrayImageReader(np.zeros((3, 5, 7)), {"PhysicalSizeX": 0.2})
+    metadata = image_reader.get_metadata()
+    assert (metadata["SizeC"], metadata["SizeZ"], metadata["SizeT"]) == (1, 1, 3)
+    assert (metadata["SizeY"], metadata["SizeX"]) == (5, 7)
+    assert metadata["PhysicalSizeX"] == 0.2
+    assert len(list(image_reader)) == 3
+
+
+def make_results(start, stop):
+    index = np.arange(start, stop)
+    return pd.DataFrame(
+        {
+            "Id": index % 5,
+            "AquisitionDate": pd.Timestamp("2020-01-01")
+            + pd.to_timedelta(index * 7, unit="h"),
+            "LensNA": np.where(index % 2, 1.4, 0.8),
+            "ChannelLabel": np.where(index % 3, "GFP", "DAPI"),
+            "PhysicalSizeX": 0.1,
+            "SNR": index / 10,
+            "resolution": index / 100,
+        },
+        index=index,
+    )
+
+
+def test_results_store(tmp_path):
+    store = batch.ResultsStore(tmp_path / "measures.hf5")
+    # both chunks have data on 2020-01-09
+    store.append("image_decorr", make_results(0, 30))
+    store.append("image_decorr", make_results(30, 50), update_rollup=False)
+    assert store.rollup("image_decorr")["count"].sum() == 30
+    assert store.refresh_rollups() > 0
+    assert store.refresh_rollups() == 0
+
+    data = store.query(
+        "image_decorr", ChannelLabel="GFP", Id=[1, 2], start="2020-01-03"
+    )
+    expected = make_results(0, 50)
+    expected = expected[
+        (expected["ChannelLabel"] == "GFP")
+        & expected["Id"].isin([1, 2])
+        & (expected["AquisitionDate"] >= "2020-01-03")
+    ]
+    np.testing.assert_array_equal(data.index, expected.index)
+
+    rollup = store.rollup("image_decorr")
+    assert rollup["count"].sum() == 50
+    assert rollup.duplicated(["date", "LensNA", "ChannelLabel"]).sum() == 0
+    day = rollup[
+        (rollup["date"] == "2020-01-09")
+        & (rollup["LensNA"] == 1.4)
+        & (rollup["ChannelLabel"] == "GFP")
+    ]
+    expected = make_results(0, 50)
+    expected = expected[
+        (expected["AquisitionDate"].dt.normalize() == "2020-01-09")
+        & (expected["LensNA"] == 1.4)
+        & (expected["ChannelLabel"] == "GFP")
+    ]
+    np.testing.assert_almost_equal(
+        day["resolution_p50"].iloc[0], expected["resolution"].median()
+    )
+
+    rollup = store.rollup("image_decorr", stop="2020-01-03", ChannelLabel="DAPI")
+    assert set(rollup["ChannelLabel"]) == {"DAPI"}
+    assert rollup["date"].max() == pd.Timestamp("2020-01-02")
+
+
+def test_parquet_sink(tmp_path):
+    pytest.importorskip("pyarrow")
+    sink = batch.ParquetSink(tmp_path)
+    num_records = batch.measure_to_sink(
+        sink, make_reader(), mean_measure, columns, chunksize=10
+    )
+    assert num_records == 24
+    assert len(list(tmp_path.glob("module=test_batch/date=2000-01-01/*.parquet"))) == 3
+
+    data = batch.read_parquet(tmp_path, "test_batch")
+    assert data.shape == (24, len(columns))
+    assert data["C"].dtype == np.int64
+    np.testing.assert_array_equal(np.sort(data["mean"]), np.arange(24))
+
+    data = batch.read_parquet(
+        tmp_path, "test_batch", columns=["mean"], filters=[("C", "==", 1)]
+    )
+    assert list(data.columns) == ["mean"]
+    assert data.shape[0] == 12
+    assert batch.read_parquet(tmp_path, "test_batch", start="2000-01-02").empty
+
+
+def test_parquet_sink_mixed_chunks(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    sink = batch.ParquetSink(tmp_path)
+    data = batch.measure_single(make_reader(), mean_measure, columns)
+    empty = data.copy()
+    # no NA for this objective, the values are all None
+    empty["LensNA"] = None
+    empty["ChannelLabel"] = None
+    sink.write("test_batch", empty.iloc[:12])
+    sink.write("test_batch", empty.iloc[12:])
+    sink.write("test_batch", data)
+
+    # all the files share the schema, whatever the file read first
+    schemas = [pq.read_schema(path) for path in tmp_path.rglob("*.parquet")]
+    assert all(schema.equals(schemas[0]) for schema in schemas)
+    data = batch.read_parquet(tmp_path, "test_batch")
+    assert data.shape == (48, len(columns))
+    assert data["LensNA"].dtype == np.float64
+    assert data["LensNA"].isna().sum() == 24
+    assert data["Id"].dtype == np.int64
+
+
+def test_file_image_reader(tmp_path):
+    import tifffile
+    from skimage.io import imsave
+
+    from auto_metro.imageio import FileImageReader
+
+    stack = np.arange(3 * 5 * 7, dtype=np.uint16).reshape((3, 5, 7))
+    tifffile.imwrite(
+        tmp_path / "stack.tif", stack, imagej=True, metadata={"axes": "ZYX"}
+    )
+    image_reader = FileImageReader(tmp_path / "stack.tif")
+    metadata = image_reader.get_metadata()
+    assert (metadata["SizeC"], metadata["SizeZ"], metadata["SizeT"]) == (1, 3, 1)
+    assert (metadata["SizeY"], metadata["SizeX"]) == (5, 7)
+    np.testing.assert_array_equal(image_reader.get_plane(0, 2, 0), stack[2])
+
+    rgb = np.zeros((5, 7, 3), dtype=np.uint8)
+    rgb[..., 1] = 255
+    imsave(tmp_path / "rgb.png", rgb, check_contrast=False)
+    image_reader = FileImageReader(tmp_path / "rgb.png")
+    metadata = image_reader.get_metadata()
+    assert (metadata["SizeC"], metadata["SizeZ"], metadata["SizeT"]) == (3, 1, 1)
+    assert image_reader.get_plane(1, 0, 0).min() == 255
+
+    # no axes metadata, the pages are of unknown type
+    tifffile.imwrite(tmp_path / "unknown.tif", np.zeros((6, 5, 7), dtype=np.uint16))
+    with pytest.raises(ValueError):
+        FileImageReader(tmp_path / "unknown.tif")
@@ -0,0 +1,110 @@
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+import pytest
+from skimage import img_as_float
+from skimage.io import imread
+
+from auto_metro import batch, cli
+from auto_metro.imageio import ArrayImageReader
+
+sample = "../samples/corti00.tif"
+
+
+def test_tune():
+    plane = img_as_float(imread(sample))
+    workers, threads, plane_time = cli.tune(plane, {}, num_cpus=4, repeat=1)
+    assert workers * threads <= 4
+    assert threads in (1, 2, 4)
+    assert plane_time > 0
+
+
+def test_calibration_plane():
+    plane = np.arange(2000 * 600).reshape((2000, 600))
+    crop = cli.calibration_plane(plane)
+    assert crop.shape == (512, 512)
+    assert crop[0, 0] == plane[744, 44]
+    assert cli.calibration_plane(plane[:100]).shape == (100, 512)
+
+
+def test_cost_model():
+    plane = np.zeros((1000, 1000))
+    model = cli.cost_model(plane, 0.5)
+    metadata = {"SizeX": 512, "SizeY": 512, "SizeZ": 4, "SizeC": 2, "SizeT": 1}
+    assert model.predict(metadata) == pytest.approx(model.overhead + 4.0)
+    metadata.update(SizeX=1024, SizeY=1024)
+    assert model.predict(metadata) > model.overhead + 16.0
+
+
+def test_file_id(tmp_path, monkeypatch):
+    assert cli.file_id(sample) == cli.file_id(os.path.abspath(sample))
+    assert cli.file_id(sample) != cli.file_id("../samples/other.tif")
+    assert 0 <= cli.file_id(sample) < 2**53
+    # relative paths are resolved from the working directory
+    before = cli.file_id(sample)
+    monkeypatch.chdir(tmp_path)
+    assert cli.file_id(sample) != before
+
+
+def test_main_local(tmp_path, capsys):
+    output = tmp_path / "measures.hf5"
+    args = ["--output", str(output), "--workers", "2", "--threads", "1"]
+    args += ["--log-dir", str(tmp_path), "local", "--pixel-size", "0.3"]
+    args += [sample, sample]
+    assert cli.main(args) == 0
+    assert "2 planes from 2 images" in capsys.readouterr().out
+
+    data = pd.read_hdf(output, "image_decorr")
+    assert (data["Id"] == cli.file_id(sample)).all()
+    assert (data["Path"] == os.path.abspath(sample)).all()
+    np.testing.assert_allclose(data["SNR"], 0.6, rtol=0.05)
+    np.testing.assert_allclose(data["resolution"], 1.8, rtol=0.05)
+    np.testing.assert_allclose(data["PhysicalSizeX"], 0.3)
+    assert (data["resolution_unit"] == "µm").all()
+
+
+def worker_threads():
+    from scipy.fft import get_workers
+    from threadpoolctl import threadpool_info
+
+    return get_workers(), [info["num_threads"] for info in threadpool_info()]
+
+
+def test_worker_thread_limits():
+    pytest.importorskip("threadpoolctl")
+    with Pool(1, initializer=cli._init_worker, initargs=(3,)) as pool:
+        fft_workers, blas_threads = pool.apply(worker_threads)
+    assert fft_workers == 3
+    assert blas_threads and all(n == 3 for n in blas_threads)
+
+
+def fake_omero_reader(credentials, im_id):
+    plane = img_as_float(imread(sample))
+    return ArrayImageReader(
+        np.stack([plane, plane[::-1]])[:, np.newaxis],
+        {"Id": im_id, "PhysicalSizeX": 0.3},
+    )
+
+
+def test_queue_workers(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(cli, "_omero_reader", fake_omero_reader)
+    monkeypatch.setenv("OMERO_PASSWORD", "secret")
+    queue = str(tmp_path / "queue.db")
+    output = str(tmp_path / "measures")
+
+    assert cli.main(["enqueue", queue, "--ids", "11", "12", "13", "14"]) == 0
+    args = ["--workers", "2", "--threads", "1", "--output", output]
+    args += ["--log-dir", str(tmp_path), "worker", queue, "--user", "me"]
+    assert cli.main(args) == 0
+    assert "Processed 4 images" in capsys.readouterr().out
+
+    results = batch.SQLiteWorkQueue(queue).results()
+    assert (results["status"] == "done").all()
+    assert (results["attempts"] == 1).all()
+    assert (results["result"] == 2).all()
+
+    data = batch.read_parquet(output, "image_decorr")
+    assert sorted(data["Id"]) == [11, 11, 12, 12, 13, 13, 14, 14]
+    np.testing.assert_allclose(data["resolution"], 1.8, rtol=0.05)
@@ -1,7 +1,7 @@
 import numpy as np
 from scipy.fft import fft2
 
-from auto_metro.image_decorr import apodise, measure
+from auto_metro.image_decorr import ImageDecorr, apodise, measure
 from skimage import img_as_float
 from skimage.io import imread
 
@@ -9,9 +9,19 @@ from skimage.io import imread
 def test_measure():
     corti = img_as_float(imread("../samples/corti00.tif"))
     metadata = {"physicalSizeX": 0.3}
-    snr, res = measure(corti, metadata).values()
+    snr, res, unit = measure(corti, metadata).values()
     np.testing.assert_approx_equal(snr, 0.6, significant=2)
     np.testing.assert_approx_equal(res, 1.8, significant=2)
+    assert unit == "µm"
+
+
+def test_measure_unit():
+    corti = img_as_float(imread("../samples/corti00.tif"))
+    measured = measure(corti, {})
+    assert measured["resolution_unit"] == "pixel"
+    np.testing.assert_approx_equal(measured["resolution"], 6.0, significant=2)
+    measured = measure(corti, {"PhysicalSizeX": 300, "PhysicalSizeXUnit": "nm"})
+    assert measured["resolution_unit"] == "nm"
 
 
 def test_apodise():
@@ -24,3 +34,4 @@ def test_apodise():
     np.testing.assert_array_almost_equal(
         ap_image[400:410, 300:310], image[400:410, 300:310], decimal=3
     )
+
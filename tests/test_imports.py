@@ -0,0 +1,53 @@
+import os
+import subprocess
+import sys
+
+# Maximum time to import the measure modules in a fresh interpreter, in seconds
+IMPORT_BUDGET = 1.0
+
+MODULES = [
+    "auto_metro.imageio",
+    "auto_metro.image_decorr",
+    "auto_metro.myopic_deconv",
+    "auto_metro.zernike",
+]
+
+
+def run_python(code, cwd=None):
+    # the child interpreter sees the same modules as the tests
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=cwd,
+        env=env,
+    )
+    return out.stdout.split()
+
+
+def test_no_heavy_imports():
+    code = f"""
+import sys
+import {', '.join(MODULES)}
+print(*[m in sys.modules for m in ("matplotlib", "scipy.signal", "pandas")])
+"""
+    assert run_python(code) == ["False", "False", "False"]
+
+
+def test_import_budget():
+    code = f"""
+import time
+start = time.perf_counter()
+import {', '.join(MODULES)}
+print(time.perf_counter() - start)
+"""
+    # best of three to smooth out cold caches
+    duration = min(float(run_python(code)[0]) for _ in range(3))
+    assert duration < IMPORT_BUDGET
+
+
+def test_batch_import_side_effects(tmp_path):
+    run_python("import auto_metro.batch", cwd=tmp_path)
+    assert not list(tmp_path.iterdir())